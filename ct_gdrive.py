@@ -34,14 +34,19 @@ import argparse
 from functools import wraps
 import httplib
 import httplib2
+import io
 import logging
+import Queue
 import random
 import os
 import re
-import simplejson
+import json
+import signal
 import socket
-from subprocess import Popen, PIPE
+import sqlite3
+from subprocess import check_output, CalledProcessError
 import sys
+import threading
 import time
 
 # Google API imports
@@ -49,16 +54,65 @@ from apiclient import discovery
 import oauth2client
 from oauth2client import tools
 
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.http import MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 
 
+# Seed the PRNG per process: many copytools backing off at the same
+# time must not share the same jitter sequence, or their retry storms
+# would stay synchronized and defeat the randomization
+random.seed(os.urandom(8))
+
+# Module logger, bound once: logging.getLogger takes a lock and walks
+# the logger hierarchy on every call
+LOGGER = logging.getLogger(__name__)
+
+
 # On-disk credentials filename (see ct_gdrive_oauth2.py)
 OAUTH2_STORAGE_CREDS_FILENAME = 'ct_gdrive_creds.json'
 
-# Our own exponential backoff max sleep time in seconds
+# On-disk local Lustre FID -> Drive file ID index filename
+FID_INDEX_FILENAME = 'fid_index.sqlite'
+
+# On-disk Drive APIv3 discovery document snapshot filename
+DISCOVERY_DOC_FILENAME = 'drive_v3_discovery.json'
+
+# Unix socket of the optional archive daemon (see --action=daemon)
+DAEMON_SOCKET_FILENAME = 'ct_gdrive.sock'
+
+# On-disk rolling RTT/bandwidth estimates filename
+STATS_FILENAME = 'ct_gdrive_stats.json'
+
+# Bounds of the dynamic resumable upload chunk size; the lower bound
+# is also used when no transfer statistics are available yet
+MIN_MEDIA_CHUNK_SIZE = 16*1024*1024
+MAX_MEDIA_CHUNK_SIZE = 128*1024*1024
+
+# Chunk sizes must stay multiples of 256 KB (Drive API requirement)
+MEDIA_CHUNK_SIZE_ALIGN = 256*1024
+
+# Weight of the latest sample in the rolling RTT/bandwidth estimates
+STATS_EMA_WEIGHT = 0.2
+
+# Where the Drive APIv3 discovery document is fetched from
+GAPI_DISCOVERY_URI = \
+    'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+
+# Our own exponential backoff max sleep time in seconds (clamp, not
+# abort: a rate-limit storm should serialize, not kill the transfer)
 MAX_EXPONENTIAL_SLEEP_SECS = 2100
 
+# Give up retrying after that many attempts
+MAX_BACKOFF_ATTEMPTS = 16
+
+# Initial attempt count: first retry sleeps ~2**(floor+1) secs, so a
+# floor of 1 makes it ~4 secs instead of ~2
+BACKOFF_ATTEMPT_FLOOR = 1
+
+# 403 reasons that only mean "slow down" and are worth retrying; any
+# other 403 (eg. insufficient permissions) is fatal
+GAPI_403_RETRYABLE_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
 # Values passed to the Drive API
 
 # Integer, number of times to retry 500's with randomized exponential
@@ -69,31 +123,67 @@ GAPI_500_NUM_RETRIES = 10
 
 # Files larger than 256 KB (256 * 1024 B) must have chunk sizes that
 # are multiples of 256 KB.
-GAPI_MEDIA_IO_CHUNK_SIZE = 16*1024*1024
+GAPI_MEDIA_IO_CHUNK_SIZE = 64*1024*1024
+
+# Base URI used to manually initiate resumable upload sessions
+GAPI_UPLOAD_URI = 'https://www.googleapis.com/upload/drive/v3/files'
+
+# Default size in bytes above which uploads switch to chunked resumable
+# mode; smaller files are sent as a single streaming request (see
+# --streaming-threshold and drive_push_media_body())
+STREAMING_THRESHOLD = 256*1024*1024
+
+# Lustre FID with optional braces, eg. [0x200000401:0x1:0x0]
+FID_REGEX = re.compile(r'^\[?(0x[\da-f]+:0x[\da-f]+:0x[\da-f]+)\]?$')
+
+# Shared httplib2.Http object, authorized once per process and then
+# reused by every API call and media chunk transfer. httplib2 keeps
+# connections alive by default, so this saves one TCP+TLS handshake
+# per request (including each media upload/download chunk).
+_HTTP = None
+
+# OAuth2 credentials and discovery document, loaded once per process
+# and kept warm in memory for daemon workers (see ct_gdrive_daemon())
+_CREDENTIALS = None
+_DISCOVERY_DOC = None
 
 
 def get_parser():
     """lhsm_gdrive command line options"""
     parser = argparse.ArgumentParser(add_help=False)
     # commands
-    parser.add_argument('--action', choices=('pull', 'push'), required=True)
-    # mandatory fd
-    parser.add_argument('--fd', type=int, required=True)
-    # mandatory Lustre fid
-    parser.add_argument('--fid', required=True)
+    parser.add_argument('--action', choices=('pull', 'push', 'daemon'),
+                        required=True)
+    # fd (mandatory for pull/push)
+    parser.add_argument('--fd', type=int)
+    # Lustre fid (mandatory for pull/push)
+    parser.add_argument('--fid')
     # Lustre mount point
     parser.add_argument("--lustre-root", required=True)
     # Gdrive root ID
     parser.add_argument("--gdrive-root", required=True)
     # Credentials directory
     parser.add_argument("--creds-dir", required=True)
+    # File size in bytes above which uploads use resumable mode
+    parser.add_argument("--streaming-threshold", type=int,
+                        default=STREAMING_THRESHOLD)
 
     return argparse.ArgumentParser(parents=[tools.argparser, parser])
 
-args = get_parser().parse_args()
+# Parsed command line options, set by main(): parsing is deferred so
+# that importing this module (eg. for tests) does not touch sys.argv
+args = None
+
 
-# oauth2 client: do not run a local web server
-args.noauth_local_webserver = True
+def warm_http_connection(http):
+    """
+    Issue a lightweight request so the TCP+TLS connection to the API
+    endpoint is already established when the first real API call runs.
+    """
+    try:
+        http.request('https://www.googleapis.com/', 'HEAD')
+    except (socket.error, httplib2.HttpLib2Error), exc:
+        LOGGER.debug("warm_http_connection: %s", exc)
 
 
 def oauth2_drive_service():
@@ -105,19 +195,60 @@ def oauth2_drive_service():
     been stored, or if the stored credentials are invalid. Use another
     script named ct_gdrive_oauth2.py for that.
     """
-    # Get credentials from storage
-    creds_path = os.path.join(args.creds_dir, OAUTH2_STORAGE_CREDS_FILENAME)
-
-    credentials = oauth2client.file.Storage(creds_path).get()
-
-    if not credentials or credentials.invalid:
-        raise Exception('Unauthorized Access!')
-
-    # Authorize http requests
-    http = credentials.authorize(httplib2.Http())
+    global _HTTP, _CREDENTIALS, _DISCOVERY_DOC
+
+    warmup = None
+    if _HTTP is None:
+        http = httplib2.Http()
+
+        # Establish the TCP+TLS connection to the API endpoint in the
+        # background while the credentials are loaded from disk below,
+        # so the first real API request finds a warm connection
+        warmup = threading.Thread(target=warm_http_connection, args=(http,))
+        warmup.daemon = True
+        warmup.start()
+
+    if _CREDENTIALS is None:
+        # Get credentials from storage
+        creds_path = os.path.join(args.creds_dir,
+                                  OAUTH2_STORAGE_CREDS_FILENAME)
+
+        _CREDENTIALS = oauth2client.file.Storage(creds_path).get()
+
+        if not _CREDENTIALS or _CREDENTIALS.invalid:
+            _CREDENTIALS = None
+            raise Exception('Unauthorized Access!')
+
+    if _HTTP is None:
+        warmup.join()
+        # Authorize http requests once on the shared keep-alive object
+        _HTTP = _CREDENTIALS.authorize(http)
+
+    # Build the service from a local snapshot of the discovery document:
+    # fetching it from Google is a 100+ KB round-trip otherwise paid by
+    # every copytool invocation
+    if _DISCOVERY_DOC is None:
+        doc_path = os.path.join(args.creds_dir, DISCOVERY_DOC_FILENAME)
+        try:
+            with open(doc_path) as doc_file:
+                _DISCOVERY_DOC = doc_file.read()
+        except IOError:
+            # First run: fetch the discovery document and snapshot it
+            # for subsequent invocations
+            resp, doc = _HTTP.request(GAPI_DISCOVERY_URI, 'GET')
+            if resp.status != 200:
+                raise HttpError(resp, doc, uri=GAPI_DISCOVERY_URI)
+
+            # write + rename so concurrent workers never read a
+            # partial doc
+            tmp_path = '%s.%d' % (doc_path, os.getpid())
+            with open(tmp_path, 'w') as doc_file:
+                doc_file.write(doc)
+            os.rename(tmp_path, doc_path)
+            _DISCOVERY_DOC = doc
 
     # Return an authorized Drive APIv3 service object
-    return discovery.build('drive', 'v3', http=http)
+    return discovery.build_from_document(_DISCOVERY_DOC, http=_HTTP)
 
 
 def exponential_backoff(func):
@@ -129,125 +260,402 @@ def exponential_backoff(func):
     @wraps(func)
     def wrapper(*fargs, **fkwargs):
         """wrapper function"""
-        attempt_cnt = 0
+        attempt_cnt = BACKOFF_ATTEMPT_FLOOR
         while True:
             try:
                 return func(*fargs, **fkwargs)
             except (socket.error, HttpError, httplib.BadStatusLine), exc:
-                logger = logging.getLogger(__name__)
                 func_name = func.__name__
-                logger.error("%s: %s", func_name, exc)
+                LOGGER.error("%s: %s", func_name, exc)
 
                 if hasattr(exc, 'content'):
-                    error = simplejson.loads(exc.content).get('error')
+                    # the body is whatever the server sent: chunk PUT
+                    # and ranged GET 5xx responses are routinely empty
+                    # or HTML, so only classify the error when it
+                    # parses and treat anything else as retryable
+                    try:
+                        error = json.loads(exc.content).get('error', {})
+                    except (ValueError, AttributeError):
+                        error = {}
                     code = error.get('code')
                     message = error.get('message', '')
-                    if code != 403 and code < 500:
-                        logger.error("%s: Http fatal error %s (%s)", func_name,
+                    if code == 403:
+                        # only retry rate-limit 403s
+                        # the errors list can also be present but empty
+                        reason = (error.get('errors') or
+                                  [{}])[0].get('reason', '')
+                        if reason not in GAPI_403_RETRYABLE_REASONS:
+                            LOGGER.error("%s: Http fatal error %s (%s: %s)",
+                                         func_name, code, reason, message)
+                            raise
+                    elif code is not None and code < 500:
+                        LOGGER.error("%s: Http fatal error %s (%s)", func_name,
                                      code, message)
                         raise # we want to see the full backtrace
 
                 attempt_cnt += 1
-                exp_sleep_secs = (2 ** attempt_cnt) + \
-                                 float(random.randint(0, 1000)) / 1000.0
-
-                if exp_sleep_secs > MAX_EXPONENTIAL_SLEEP_SECS:
-                    logger.error("%s: aborting exponential backoff", func_name)
+                if attempt_cnt >= MAX_BACKOFF_ATTEMPTS:
+                    LOGGER.error("%s: aborting exponential backoff", func_name)
                     raise
 
-                logger.warning("%s: sleeping %s secs", func_name,
+                # clamped: never serialize more than the max at once
+                exp_sleep_secs = min((1 << attempt_cnt) + random.random(),
+                                     MAX_EXPONENTIAL_SLEEP_SECS)
+
+                LOGGER.warning("%s: sleeping %s secs", func_name,
                                exp_sleep_secs)
                 time.sleep(exp_sleep_secs)
-                logger.info("%s: now retrying", func_name)
+                LOGGER.info("%s: now retrying", func_name)
     return wrapper
 
 @exponential_backoff
 def drive_list_files(query, service):
     """List Drive file IDs matching the given query (w/o pagination)"""
+    # pageSize=2 is enough to detect (and warn about) duplicate entries
+    # while sparing the server the default allocation of 100 results
     return service.files() \
-                  .list(q=query, fields="files(id)") \
+                  .list(q=query, fields="files(id,size)", pageSize=2,
+                        spaces='drive') \
                   .execute(num_retries=GAPI_500_NUM_RETRIES) \
                   .get('files', [])
 
 def drive_lookup(parent, name, service):
     """Retrieve Google Drive file ID by parentID and name"""
+    # backslash-escape the name as per the Drive API query syntax: a
+    # quote would otherwise break the query and cost a retry round-trip
+    name_esc = name.replace("\\", "\\\\").replace("'", "\\'")
     query_fmt = "'%s' in parents and name = '%s' and trashed = false"
-    query = query_fmt % (parent, name)
+    query = query_fmt % (parent, name_esc)
     return drive_list_files(query=query, service=service)
 
+#
+# Local FID index functions
+#
+def fid_index_connect():
+    """
+    Open (creating it if needed) the local Lustre FID -> Drive file ID
+    index database, kept along with the credentials in --creds-dir.
+
+    The index is only a cache used to skip the costly drive_lookup on
+    archive: Google Drive remains the reference, a stale entry is
+    detected (404) and invalidated at push time.
+    """
+    db_path = os.path.join(args.creds_dir, FID_INDEX_FILENAME)
+    conn = sqlite3.connect(db_path)
+    # WAL allows concurrent readers from multiple copytool workers
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS fid_index "
+                 "(fid TEXT PRIMARY KEY, drive_id TEXT, mtime INTEGER)")
+    return conn
+
+def fid_index_lookup(fid_index, lustre_fid):
+    """Return the indexed Drive file ID for a Lustre FID (None on miss)"""
+    row = fid_index.execute("SELECT drive_id FROM fid_index WHERE fid = ?",
+                            (lustre_fid,)).fetchone()
+    if row:
+        return row[0]
+    return None
+
+def fid_index_store(fid_index, lustre_fid, drive_fid):
+    """Index the Drive file ID of a successfully archived Lustre FID"""
+    fid_index.execute("INSERT OR REPLACE INTO fid_index VALUES (?, ?, ?)",
+                      (lustre_fid, drive_fid, int(time.time())))
+    fid_index.commit()
+
+def fid_index_remove(fid_index, lustre_fid):
+    """Invalidate the indexed Drive file ID of a Lustre FID"""
+    fid_index.execute("DELETE FROM fid_index WHERE fid = ?", (lustre_fid,))
+    fid_index.commit()
+
+#
+# Transfer statistics functions
+#
+def transfer_stats_path():
+    """Path of the on-disk rolling RTT/bandwidth estimates"""
+    return os.path.join(args.creds_dir, STATS_FILENAME)
+
+def load_transfer_stats():
+    """Load the rolling RTT/bandwidth estimates (empty dict if none)"""
+    try:
+        with open(transfer_stats_path()) as stats_file:
+            return json.load(stats_file)
+    except (IOError, ValueError):
+        return {}
+
+def save_transfer_stats(stats):
+    """Persist the rolling RTT/bandwidth estimates (best effort)"""
+    try:
+        tmp_path = '%s.%d' % (transfer_stats_path(), os.getpid())
+        with open(tmp_path, 'w') as stats_file:
+            json.dump(stats, stats_file)
+        os.rename(tmp_path, transfer_stats_path())
+    except (IOError, OSError), exc:
+        LOGGER.debug("save_transfer_stats: %s", exc)
+
+def update_transfer_stats(stats, key, sample):
+    """Fold a new sample into a rolling estimate"""
+    if key in stats:
+        stats[key] = (1.0 - STATS_EMA_WEIGHT) * stats[key] \
+                     + STATS_EMA_WEIGHT * sample
+    else:
+        stats[key] = sample
+
+def dynamic_chunk_size(stats):
+    """
+    Pick the resumable upload chunk size from the rolling estimates:
+    about 4x the measured bandwidth-delay product keeps a high-BDP
+    link busy, bounded to [MIN_MEDIA_CHUNK_SIZE, MAX_MEDIA_CHUNK_SIZE]
+    and aligned to 256 KB as the Drive API requires.
+    """
+    rtt = stats.get('rtt_secs')
+    bandwidth = stats.get('bw_bytes_per_sec')
+    if not rtt or not bandwidth:
+        return MIN_MEDIA_CHUNK_SIZE
+
+    chunk_size = int(min(MAX_MEDIA_CHUNK_SIZE,
+                         max(MIN_MEDIA_CHUNK_SIZE, 4 * rtt * bandwidth)))
+    return chunk_size - chunk_size % MEDIA_CHUNK_SIZE_ALIGN
+
 def description_by_fid(lustre_fid):
     """
     This is what we use as the file description in Google Drive at Stanford
     Research Computing. This is probably to be improved. It is good to have
     a human readable file path, but you can put whatever you want here.
     """
-    cmd_descr_fmt = 'lfs fid2path "%s" "%s"; ' \
-                    'stat %s/.lustre/fid/%s; ' \
-                    'echo Archived by $HOSTNAME on $(date)'
 
-    cmd_descr = cmd_descr_fmt % (args.lustre_root, lustre_fid,
-                                 args.lustre_root, lustre_fid)
+    # `lfs fid2path` is the only part that needs an external command:
+    # run it directly (no shell) and gather the rest in-process, saving
+    # two fork/exec pairs per archive
+    try:
+        path = check_output(['lfs', 'fid2path', args.lustre_root,
+                             lustre_fid]).strip()
+    except (OSError, CalledProcessError), exc:
+        LOGGER.warning("description_by_fid: lfs fid2path: %s", exc)
+        path = 'unknown'
 
-    return Popen(cmd_descr, stdout=PIPE, shell=True).communicate()[0]
+    try:
+        statinfo = os.stat('%s/.lustre/fid/%s' % (args.lustre_root,
+                                                  lustre_fid))
+        stat_descr = 'size: %d uid: %d gid: %d mtime: %s\n' \
+                     % (statinfo.st_size, statinfo.st_uid, statinfo.st_gid,
+                        time.ctime(statinfo.st_mtime))
+    except OSError, exc:
+        LOGGER.warning("description_by_fid: stat: %s", exc)
+        stat_descr = ''
+
+    return '%s\n%sArchived by %s on %s\n' \
+           % (path, stat_descr, socket.gethostname(),
+              time.strftime('%a %b %d %H:%M:%S %Z %Y'))
 
 #
 # GDrive push functions
 #
-@exponential_backoff
-def drive_push_create_media(body, media, service):
-    """Create a new file in Google Drive and upload media"""
-    return service.files() \
-                  .create(body=body, media_body=media) \
-                  .execute(num_retries=GAPI_500_NUM_RETRIES)
+def drive_push_media_body(lustre_file):
+    """
+    Build the single-request streaming media body used to upload files
+    smaller than --streaming-threshold. Larger files go through
+    drive_push_resumable() instead.
+    """
+    return MediaIoBaseUpload(lustre_file,
+                             mimetype='application/octet-stream',
+                             resumable=False)
 
-def drive_push_create(service, lustre_fid):
-    """Push a new file to Google Drive"""
-    logger = logging.getLogger(__name__)
-    logger.debug("drive_push_create lustre_fid %s from fd %d", lustre_fid,
-                 args.fd)
+def drive_resumable_session_uri(drive_fid, body):
+    """
+    Initiate a resumable upload session and return its URI.
 
-    body = {'mimeType': 'application/octet-stream',
-            'name': lustre_fid,
-            'description': description_by_fid(lustre_fid),
-            'parents': [args.gdrive_root]}
+    Creates a new Drive file when drive_fid is None, otherwise uploads
+    a new version of the existing Drive file.
+    """
+    if drive_fid is None:
+        uri = '%s?uploadType=resumable' % GAPI_UPLOAD_URI
+        method = 'POST'
+    else:
+        uri = '%s/%s?uploadType=resumable' % (GAPI_UPLOAD_URI, drive_fid)
+        method = 'PATCH'
+
+    headers = {'content-type': 'application/json; charset=UTF-8',
+               'x-upload-content-type': 'application/octet-stream'}
+
+    resp, content = _HTTP.request(uri, method, body=json.dumps(body),
+                                  headers=headers)
+    if resp.status != 200:
+        raise HttpError(resp, content, uri=uri)
+
+    return resp['location']
 
-    # Open a Python file based on inherited Lustre file descriptor
-    with os.fdopen(args.fd, 'r') as lustre_file:
-        # Upload content directly using Lustre file
-        media = MediaIoBaseUpload(lustre_file,
-                                  mimetype='application/octet-stream',
-                                  chunksize=GAPI_MEDIA_IO_CHUNK_SIZE,
-                                  resumable=True)
+@exponential_backoff
+def drive_push_resumable(drive_fid, body):
+    """
+    Push the content of a large Lustre file through a manually driven
+    resumable upload session.
+
+    The Drive API requires resumable chunks to be sent in order with
+    contiguous Content-Range headers, so chunk PUTs cannot be issued
+    concurrently against a single session. Instead, a read-ahead
+    thread fetches the next chunk from Lustre while the current one is
+    in flight, so file system reads overlap the network transfer and
+    the pipe never sits idle waiting on a Lustre read.
+    """
+    size = os.fstat(args.fd).st_size
+
+    # Size chunks from the rolling bandwidth-delay product estimates;
+    # the session initiation below is a small request, so its duration
+    # doubles as an RTT sample
+    stats = load_transfer_stats()
+    chunk_size = dynamic_chunk_size(stats)
+
+    start_time = time.time()
+    session_uri = drive_resumable_session_uri(drive_fid=drive_fid, body=body)
+    update_transfer_stats(stats, 'rtt_secs', time.time() - start_time)
+
+    # Restart from byte 0 if re-executed by exponential_backoff
+    os.lseek(args.fd, 0, os.SEEK_SET)
+
+    chunks = Queue.Queue(maxsize=2)
+    stop = threading.Event()
+    reader_error = []
+
+    def chunk_reader():
+        """read-ahead thread: fill the chunk queue from the Lustre fd"""
+        try:
+            while not stop.is_set():
+                data = os.read(args.fd, chunk_size)
+                chunks.put(data)
+                if not data:
+                    break
+        except OSError, exc:
+            # surface Lustre read errors (EIO, ESTALE, ...) to the
+            # upload loop instead of dying silently
+            reader_error.append(exc)
+
+    reader = threading.Thread(target=chunk_reader)
+    reader.daemon = True
+    reader.start()
 
-        return drive_push_create_media(body=body, media=media, service=service)
+    try:
+        offset = 0
+        content = None
+        while offset < size:
+            # bounded get, re-checking on the reader: if it died on a
+            # Lustre read error, a plain get would block forever
+            while True:
+                if reader_error:
+                    raise reader_error[0]
+                try:
+                    data = chunks.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    if not reader.is_alive() and not reader_error:
+                        raise IOError("read-ahead ended early at "
+                                      "offset %d/%d" % (offset, size))
+
+            headers = {'content-range': 'bytes %d-%d/%d'
+                                        % (offset, offset + len(data) - 1,
+                                           size)}
+            start_time = time.time()
+            resp, content = _HTTP.request(session_uri, 'PUT', body=data,
+                                          headers=headers)
+            elapsed = time.time() - start_time
+            if elapsed > 0:
+                update_transfer_stats(stats, 'bw_bytes_per_sec',
+                                      len(data) / elapsed)
+
+            # Intermediate chunks are acknowledged with a 308, the last
+            # one with the complete file resource (200 or 201)
+            if resp.status not in (200, 201, 308):
+                raise HttpError(resp, content, uri=session_uri)
+
+            offset += len(data)
+
+        # Make sure the session actually finalized: a trailing 308 or
+        # an empty final body means no complete file resource
+        if resp.status not in (200, 201) or not content:
+            raise HttpError(resp, content, uri=session_uri)
+
+        save_transfer_stats(stats)
+        return json.loads(content)
+    finally:
+        # Unblock and reap the read-ahead thread so a backoff retry
+        # does not compete with it for the Lustre fd offset
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get_nowait()
+            except Queue.Empty:
+                reader.join(0.1)
 
 @exponential_backoff
 def drive_push_upload_media(drive_fid, body, media, service):
-    """Upload a new version of the given Google Drive file"""
-    return service.files() \
-                  .update(fileId=drive_fid, body=body, media_body=media) \
-                  .execute(num_retries=GAPI_500_NUM_RETRIES)
+    """
+    Upload media to Google Drive: create a new file when drive_fid is
+    None, or a new version of the given Drive file otherwise.
+    """
+    # rewind so a backoff re-execution reuploads from byte 0
+    os.lseek(args.fd, 0, os.SEEK_SET)
 
-def drive_push_update(lustre_fid, drive_fid, service):
-    """Push a new version of file to Google Drive"""
-    logger = logging.getLogger(__name__)
-    logger.debug("drive_push_update drive_fid %s for lustre_fid %s from fd %d",
-                 drive_fid, lustre_fid, args.fd)
+    if drive_fid is None:
+        request = service.files().create(body=body, media_body=media)
+    else:
+        request = service.files().update(fileId=drive_fid, body=body,
+                                         media_body=media)
 
-    body = {'mimeType': 'application/octet-stream',
-            'description': description_by_fid(lustre_fid)}
+    return request.execute(num_retries=GAPI_500_NUM_RETRIES)
 
-    media = MediaIoBaseUpload(os.fdopen(args.fd, 'r'),
-                              mimetype='application/octet-stream',
-                              chunksize=GAPI_MEDIA_IO_CHUNK_SIZE,
-                              resumable=True)
+def drive_push(lustre_fid, drive_fid, service):
+    """Push a file to Google Drive (a new file when drive_fid is None)"""
+    LOGGER.debug("drive_push lustre_fid %s drive_fid %s from fd %d",
+                 lustre_fid, drive_fid, args.fd)
 
-    return drive_push_upload_media(drive_fid, body, media, service)
+    body = {'mimeType': 'application/octet-stream',
+            'description': description_by_fid(lustre_fid)}
+    if drive_fid is None:
+        body['name'] = lustre_fid
+        body['parents'] = [args.gdrive_root]
+
+    # zero-byte files always take the single-request path: a resumable
+    # session with no chunk to PUT never finalizes
+    size = os.fstat(args.fd).st_size
+    if size and size >= args.streaming_threshold:
+        return drive_push_resumable(drive_fid=drive_fid, body=body)
+
+    # Rewind and open the inherited Lustre file descriptor; binary
+    # mode with a chunk-sized buffer avoids thousands of tiny 8 KB
+    # reads, and closefd is unset so the fd survives this upload
+    # attempt (eg. an update falling back to create on a stale index
+    # entry, or a backoff retry)
+    os.lseek(args.fd, 0, os.SEEK_SET)
+    with io.open(args.fd, 'rb', buffering=GAPI_MEDIA_IO_CHUNK_SIZE,
+                 closefd=False) as lustre_file:
+        # built once: a backoff retry reuses the same media object
+        media = drive_push_media_body(lustre_file)
+
+        return drive_push_upload_media(drive_fid=drive_fid, body=body,
+                                       media=media, service=service)
 
 def ct_gdrive_push(lustre_fid, service):
     """Main method to push/archive a file to Google Drive"""
-    logger = logging.getLogger(__name__)
-    logger.debug("ct_gdrive_push lustre_fid %s from fd %s", lustre_fid, args.fd)
+    LOGGER.debug("ct_gdrive_push lustre_fid %s from fd %s", lustre_fid, args.fd)
+
+    fid_index = fid_index_connect()
+
+    # Check the local index first: on a hit, we save a full round-trip
+    # to Google on the critical path of every archive.
+    drive_fid = fid_index_lookup(fid_index, lustre_fid)
+    if drive_fid:
+        try:
+            response = drive_push(lustre_fid=lustre_fid, drive_fid=drive_fid,
+                                  service=service)
+            fid_index_store(fid_index, lustre_fid, response['id'])
+            return response
+        except HttpError, exc:
+            if exc.resp.status != 404:
+                raise
+            # Stale index entry (file removed on the Drive side):
+            # invalidate it and fall back to a regular lookup below
+            LOGGER.warning("stale index entry for lustre_fid %s "
+                           "(drive_fid %s)", lustre_fid, drive_fid)
+            fid_index_remove(fid_index, lustre_fid)
 
     # A lookup is costly but REQUIRED to know whether a file with the
     # same _Lustre_FID_ name already exists in Google Drive.
@@ -256,16 +664,20 @@ def ct_gdrive_push(lustre_fid, service):
 
     if len(files) == 0:
         # File by Lustre FID not found: push a new file
-        return drive_push_create(lustre_fid=lustre_fid, service=service)
+        response = drive_push(lustre_fid=lustre_fid, drive_fid=None,
+                              service=service)
     else:
         if len(files) > 1:
-            logger.warning("multiple entries found for lustre_fid %s %s",
+            LOGGER.warning("multiple entries found for lustre_fid %s %s",
                            lustre_fid, files)
 
         # File already archived: push a new version of file
-        return drive_push_update(lustre_fid=lustre_fid,
-                                 drive_fid=files[0]['id'],
-                                 service=service)
+        response = drive_push(lustre_fid=lustre_fid,
+                              drive_fid=files[0]['id'],
+                              service=service)
+
+    fid_index_store(fid_index, lustre_fid, response['id'])
+    return response
 
 #
 # GDrive pull functions
@@ -273,48 +685,248 @@ def ct_gdrive_push(lustre_fid, service):
 @exponential_backoff
 def drive_pull_media(drive_fid, service):
     """Retrieve content of a Google Drive file"""
-    logger = logging.getLogger(__name__)
 
-    # Open a Python file based on inherited Lustre file descriptor
-    with os.fdopen(args.fd, 'wb') as lustre_file:
-        # Get a file content by Google fileID
-        request = service.files().get_media(fileId=drive_fid)
+    # Restart from byte 0 if re-executed by exponential_backoff
+    os.lseek(args.fd, 0, os.SEEK_SET)
 
-        downloader = MediaIoBaseDownload(lustre_file,
-                                         request,
-                                         chunksize=GAPI_MEDIA_IO_CHUNK_SIZE)
+    # Media URI of the file content (alt=media)
+    uri = service.files().get_media(fileId=drive_fid).uri
+
+    # Writer thread: drain downloaded chunks to the Lustre fd, so the
+    # write of chunk N overlaps the download of chunk N+1 instead of
+    # serializing network receive and disk write
+    chunks = Queue.Queue(maxsize=2)
+    writer_error = []
+
+    def chunk_writer():
+        """writer thread: write queued chunks to the Lustre fd"""
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            try:
+                # raw write(2) can return a partial count: loop until
+                # the whole chunk is on disk, or the next chunk would
+                # land at the wrong offset
+                while chunk:
+                    written = os.write(args.fd, chunk)
+                    chunk = chunk[written:]
+            except OSError, exc:
+                writer_error.append(exc)
+                break
+
+    writer = threading.Thread(target=chunk_writer)
+    writer.daemon = True
+    writer.start()
+
+    # Download using plain ranged GETs over the shared keep-alive Http
+    # object: this avoids the intermediate io.BytesIO copy that
+    # MediaIoBaseDownload performs on every chunk.
+    try:
+        offset = 0
+        total = None
+        while total is None or offset < total:
+            if writer_error:
+                raise writer_error[0]
+
+            headers = {'range': 'bytes=%d-%d'
+                                % (offset,
+                                   offset + GAPI_MEDIA_IO_CHUNK_SIZE - 1)}
+            resp, body = _HTTP.request(uri, 'GET', headers=headers)
+
+            if resp.status not in (200, 206):
+                raise HttpError(resp, body, uri=uri)
+
+            # bounded put, re-checking on the writer: if it died with
+            # the queue full, a plain put would block forever and the
+            # writer_error check above would never be reached
+            while True:
+                if writer_error:
+                    raise writer_error[0]
+                try:
+                    chunks.put(body, timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+
+            offset += len(body)
+
+            if resp.status == 200:
+                # Server sent the whole file in a single response
+                total = offset
+            elif total is None:
+                # Content-Range: bytes <start>-<end>/<total>
+                total = int(resp['content-range'].split('/')[-1])
+
+            # don't even compute the progress unless DEBUG is enabled
+            if total and LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Download %d%%", offset * 100 / total)
+    finally:
+        # Reap the writer thread (it consumes the None marker; when it
+        # already died on error, pending chunks are simply abandoned).
+        # Bounded puts again: the writer can die with the queue full.
+        while writer.is_alive():
+            try:
+                chunks.put(None, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        writer.join()
 
-        # Download by chunk
-        status, done = downloader.next_chunk()
-        while done is False:
-            status, done = downloader.next_chunk()
-            if status:
-                logger.debug("Download %d%%", int(status.progress() * 100))
+    if writer_error:
+        raise writer_error[0]
 
 def ct_gdrive_pull(lustre_fid, service):
     """Main method to pull/restore a file from Google Drive"""
-    logger = logging.getLogger(__name__)
-    logger.debug("ct_gdrive_pull lustre_fid %s to fd %s", lustre_fid, args.fd)
+    LOGGER.debug("ct_gdrive_pull lustre_fid %s to fd %s", lustre_fid, args.fd)
 
     files = drive_lookup(parent=args.gdrive_root, name=lustre_fid,
                          service=service)
     if len(files) == 0:
-        logger.error("ct_gdrive_pull: entry for lustre_fid %s not found!",
+        LOGGER.error("ct_gdrive_pull: entry for lustre_fid %s not found!",
                      lustre_fid)
         sys.exit(1)
 
     else:
         if len(files) > 1:
-            logger.warning("multiple entries found for lustre_fid %s %s",
+            LOGGER.warning("multiple entries found for lustre_fid %s %s",
                            lustre_fid, files)
 
+        # Preallocate the Lustre file up front: writing chunk by chunk
+        # into a growing file triggers repeated OST extent allocations
+        # and metadata updates
+        try:
+            size = int(files[0].get('size', 0))
+            if size > 0:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(args.fd, 0, size)
+                else:
+                    # no posix_fallocate in Python 2: at least set the
+                    # final file size before writing
+                    os.ftruncate(args.fd, size)
+        except OSError, exc:
+            LOGGER.warning("preallocation failed: %s", exc)
+
         drive_pull_media(drive_fid=files[0]['id'], service=service)
 
+#
+# GDrive archive daemon functions
+#
+def daemon_socket_path():
+    """Unix socket path of the archive daemon"""
+    return os.path.join(args.creds_dir, DAEMON_SOCKET_FILENAME)
+
+def daemon_serve_request(conn):
+    """Handle one push request in a forked daemon worker"""
+    global _HTTP
+
+
+    # A TLS connection cannot be shared with the parent after fork:
+    # authorize a fresh Http object from the already-loaded credentials
+    # (the only remaining per-file setup cost)
+    _HTTP = None
+    service = oauth2_drive_service()
+
+    status = 1
+    try:
+        request = json.loads(conn.makefile().readline())
+
+        if request.get('action') != 'push':
+            raise ValueError("unsupported daemon action: %s"
+                             % request.get('action'))
+
+        # validate the FID like the direct-path CLI does: it is
+        # interpolated into a path below, so reject anything else
+        # before touching the filesystem
+        fid_match = FID_REGEX.match(request.get('fid', ''))
+        if fid_match is None:
+            raise ValueError("malformed lustre fid: %s" % request.get('fid'))
+
+        lustre_fid = fid_match.group(1)
+        LOGGER.debug("daemon: push request for lustre_fid %s", lustre_fid)
+
+        # lhsmtool_cmd keeps its own fd on the file, but a worker can
+        # simply (re-)open the file to archive by FID
+        args.fd = os.open('%s/.lustre/fid/%s' % (args.lustre_root,
+                                                 lustre_fid), os.O_RDONLY)
+        ct_gdrive_push(lustre_fid, service)
+        status = 0
+    except Exception, exc:
+        LOGGER.error("daemon: %s", exc)
+
+    try:
+        conn.sendall(json.dumps({'status': status}) + '\n')
+    finally:
+        conn.close()
+    return status
+
+def ct_gdrive_daemon():
+    """
+    Serve push requests from a warm process (--action=daemon).
+
+    lhsmtool_cmd spawns a new ct_gdrive.py per Lustre file, paying
+    interpreter startup, credentials load and discovery document parse
+    every time. In daemon mode those are paid once; a cheap worker is
+    then forked per request with everything already warm in memory.
+
+    Workers open the Lustre file by FID themselves, so only push
+    (archive) requests are handled: a restore writes to a volatile file
+    descriptor that has no path and keeps using the direct path.
+    """
+
+    # Load credentials and the discovery document now so forked
+    # workers find everything warm in memory
+    oauth2_drive_service()
+
+    # Auto-reap forked workers
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    sock_path = daemon_socket_path()
+    try:
+        os.unlink(sock_path)
+    except OSError:
+        pass
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    os.chmod(sock_path, 0600)
+    server.listen(8)
+    LOGGER.info("ct_gdrive daemon serving on %s", sock_path)
+
+    while True:
+        conn, _ = server.accept()
+        if os.fork() == 0:
+            server.close()
+            os._exit(daemon_serve_request(conn))
+        conn.close()
+
+def daemon_push_request(lustre_fid):
+    """
+    Try to delegate a push to a running archive daemon. Return its
+    status, or None if no daemon is reachable (direct path fallback).
+    """
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(daemon_socket_path())
+        conn.sendall(json.dumps({'action': 'push', 'fid': lustre_fid}) + '\n')
+        response = json.loads(conn.makefile().readline())
+        conn.close()
+        return response['status']
+    except (socket.error, ValueError, KeyError), exc:
+        LOGGER.debug("no usable archive daemon (%s), using direct path", exc)
+        return None
+
 #
 # main ct_gdrive
 #
 def main():
     """main ct_gdrive.py entry point"""
+    global args
+
+    args = get_parser().parse_args()
+
+    # oauth2 client: do not run a local web server
+    args.noauth_local_webserver = True
 
     # Set logging level
     nloglevel = getattr(logging, args.logging_level.upper(), None)
@@ -325,25 +937,38 @@ def main():
     logging.basicConfig(level=nloglevel,
                         format='%(asctime)s %(name)s %(levelname)s %(message)s',
                         stream=sys.stderr)
-    logger = logging.getLogger(__name__)
 
-    try:
-        # clean Lustre FID (no braces)
-        expr = r'^\[?(0x[\da-f]+:0x[\da-f]+:0x[\da-f]+)\]?$'
-        fid_clean, = re.match(expr, args.fid).groups()
-    except AttributeError:
-        logger.error("malformed lustre fid: %s", args.fid)
+    if args.action == 'daemon':
+        return ct_gdrive_daemon()
+
+    if args.fd is None or args.fid is None:
+        LOGGER.error("--fd and --fid are required for action %s", args.action)
+        return 1
+
+    # clean Lustre FID (no braces)
+    fid_match = FID_REGEX.match(args.fid)
+    if fid_match is None:
+        LOGGER.error("malformed lustre fid: %s", args.fid)
         return 1
 
+    fid_clean = fid_match.group(1)
+
     # Run action
     if args.action == 'push':
+        # Delegate to the archive daemon when one is running
+        status = daemon_push_request(fid_clean)
+        if status is not None:
+            LOGGER.debug("push delegated to daemon for %s (status %d)",
+                         fid_clean, status)
+            return status
+
         response = ct_gdrive_push(fid_clean, oauth2_drive_service())
-        logger.debug("push successfully completed for %s (drive_fid %s)",
+        LOGGER.debug("push successfully completed for %s (drive_fid %s)",
                      fid_clean, response['id'])
         return 0
     elif args.action == 'pull':
         ct_gdrive_pull(fid_clean, oauth2_drive_service())
-        logger.debug("pull succesfully completed for %s", fid_clean)
+        LOGGER.debug("pull succesfully completed for %s", fid_clean)
         return 0
 
     return 1